@@ -4,19 +4,32 @@ InstaClaw - Production-ready SaaS platform with unified API, billing, and analyt
 """
 
 import os
-import json
+import asyncio
+import atexit
 import hashlib
+import math
+import queue
+import secrets
+import threading
+import time
 import uuid
 import bcrypt
 import jwt
 import stripe
 import redis
-import requests
+import orjson
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
 from typing import Optional, Dict, Any
 
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, flash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
+from flask import Flask, Response, request, jsonify, render_template, session, redirect, url_for, flash
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache, TemplateError
+from jinja2.utils import htmlsafe_json_dumps
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS
@@ -24,61 +37,172 @@ import sqlite3
 from dotenv import load_dotenv
 
 # Optional imports - will be done lazily to avoid startup crashes
-openai = None
+openai_client = None
 
 # Load environment variables
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize jsonify() responses with orjson instead of the stdlib json module"""
+
+    def dumps(self, obj, **kwargs):
+        # orjson covers compact separators, indent=2 and sort_keys, which is
+        # all jsonify() and the session serializer pass; anything else falls back
+        if (kwargs.keys() - {'indent', 'separators', 'sort_keys'}
+                or kwargs.get('indent') not in (None, 2)
+                or kwargs.get('separators') not in (None, (',', ':'))):
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:  # e.g. the session serializer's object_hook
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """jsonify() passes formatting kwargs to dumps(), so build the bytes here"""
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=option),
+                                        mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-prod')
 CORS(app)
 
+# Brotli/gzip for the HTML pages and JSON; /health and /ping never reach
+# Flask (see FastHealth) and the rest stay uncompressed below 500 bytes
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+try:
+    from flask_compress import Compress
+    Compress(app)
+except ImportError:
+    print("Warning: flask-compress not installed, responses will be sent uncompressed")
+
 # Initialize services (optional - app works without API keys)
 if os.getenv('STRIPE_SECRET_KEY'):
     stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+    # One keep-alive pool for every Stripe call instead of a session per thread
+    import requests
+    from requests.adapters import HTTPAdapter
+    stripe_session = requests.Session()
+    stripe_session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+    stripe.default_http_client = stripe.http_client.RequestsClient(session=stripe_session)
+
+# Lazy initialize anthropic client to avoid startup issues
+anthropic_client = None
+
+# Provider calls run on one background event loop so every request shares
+# the async clients' keep-alive connection pools
+LLM_MAX_KEEPALIVE_CONNECTIONS = 64
+LLM_KEEPALIVE_EXPIRY = 60
+LLM_TIMEOUT = 60
+LLM_CALL_TIMEOUT = 2 * LLM_TIMEOUT  # room for SDK retries, but a request never waits forever
+
+_llm_loop = None
+_llm_loop_thread = None
+_llm_loop_lock = threading.Lock()
+
+def get_llm_loop() -> asyncio.AbstractEventLoop:
+    """Get the background event loop for provider calls, starting it if needed"""
+    global _llm_loop, _llm_loop_thread, _batch_scheduler, openai_client, anthropic_client
+    if _llm_loop_thread is None or not _llm_loop_thread.is_alive():
+        with _llm_loop_lock:
+            if _llm_loop_thread is None or not _llm_loop_thread.is_alive():
+                _llm_loop = asyncio.new_event_loop()
+                _llm_loop_thread = threading.Thread(target=_llm_loop.run_forever, name='llm-loop', daemon=True)
+                _llm_loop_thread.start()
+                # Clients and queues are bound to the loop that drives them
+                openai_client = anthropic_client = None
+                _batch_scheduler = BatchScheduler()
+    return _llm_loop
+
+def run_async(coro):
+    """Run a coroutine on the background loop and wait up to LLM_CALL_TIMEOUT for its result"""
+    future = asyncio.run_coroutine_threadsafe(coro, get_llm_loop())
+    try:
+        return future.result(LLM_CALL_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+def _async_http_client():
+    """Pooled HTTP client for the provider SDKs"""
+    import httpx
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=LLM_KEEPALIVE_EXPIRY),
+        timeout=LLM_TIMEOUT
+    )
 
 def get_openai_client():
     """Lazy initialization of openai client"""
-    global openai
-    if openai is None:
+    global openai_client
+    if not os.getenv('OPENAI_API_KEY'):
+        return None
+    get_llm_loop()
+    if openai_client is None:
         try:
-            import openai as openai_module
-            openai = openai_module
-            if os.getenv('OPENAI_API_KEY'):
-                openai.api_key = os.getenv('OPENAI_API_KEY')
+            from openai import AsyncOpenAI
+            openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'),
+                                        http_client=_async_http_client())
         except Exception as e:
             print(f"Warning: Failed to initialize OpenAI client: {e}")
-            openai = False
-    return openai if openai is not False else None
-
-# Lazy initialize anthropic client to avoid startup issues
-anthropic_client = None
+            openai_client = False  # Mark as failed to avoid retry
+    return openai_client if openai_client is not False else None
 
 def get_anthropic_client():
     """Lazy initialization of anthropic client"""
     global anthropic_client
-    if anthropic_client is None and os.getenv('ANTHROPIC_API_KEY'):
+    if not os.getenv('ANTHROPIC_API_KEY'):
+        return None
+    get_llm_loop()
+    if anthropic_client is None:
         try:
-            from anthropic import Anthropic
-            anthropic_client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+            from anthropic import AsyncAnthropic
+            anthropic_client = AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'),
+                                              http_client=_async_http_client())
         except Exception as e:
             print(f"Warning: Failed to initialize Anthropic client: {e}")
             anthropic_client = False  # Mark as failed to avoid retry
     return anthropic_client if anthropic_client is not False else None
 
 # Redis setup for rate limiting
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
 try:
-    redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    redis_client = redis.Redis.from_url(REDIS_URL)
     redis_client.ping()
 except:
     redis_client = None
     print("Warning: Redis not available, using in-memory rate limiting")
 
-# Rate limiter setup
-limiter = Limiter(
-    key_func=get_remote_address,
-    storage_uri=os.getenv('REDIS_URL', 'memory://')
-)
+# Rate limiter setup. With Redis the counters are shared by every worker and
+# survive restarts, so the exact moving window is worth its cost; in memory
+# each process counts on its own and the cheaper fixed window is enough.
+if redis_client is not None:
+    limiter = Limiter(
+        key_func=get_remote_address,
+        storage_uri=REDIS_URL,
+        strategy='moving-window',
+        in_memory_fallback_enabled=True
+    )
+else:
+    limiter = Limiter(
+        key_func=get_remote_address,
+        storage_uri='memory://',
+        strategy='fixed-window'
+    )
 limiter.init_app(app)
 
 # Subscription tiers and rate limits
@@ -109,12 +233,167 @@ SUBSCRIPTION_TIERS = {
     }
 }
 
+# Reverse lookups for the webhook and rate limiter
+PRICE_TO_TIER = {v['stripe_price_id']: k for k, v in SUBSCRIPTION_TIERS.items() if v['stripe_price_id']}
+TIER_LIMIT = {k: v['rate_limit'] for k, v in SUBSCRIPTION_TIERS.items()}
+
+# Rendered into billing.html's script block; the tiers never change at runtime
+SUBSCRIPTION_TIERS_JSON = htmlsafe_json_dumps(SUBSCRIPTION_TIERS, dumps=lambda obj, **kwargs: orjson.dumps(obj).decode())
+
+# Password hashing - argon2id for new hashes, bcrypt still accepted for older rows
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+# Digests of recently verified (password, stored hash) pairs, so repeat logins
+# skip the KDF. Keyed per process; a changed hash never matches old entries.
+_verified_passwords = TTLCache(maxsize=1024, ttl=60)
+_verified_passwords_lock = threading.Lock()
+_verified_passwords_key = os.urandom(32)
+
+def hash_password(password: str) -> str:
+    """Hash a password for storage"""
+    return password_hasher.hash(password)
+
+def verify_password(password: str, stored_hash: str) -> bool:
+    """Check a password against a stored argon2id or legacy bcrypt hash"""
+    cache_key = hashlib.blake2b(password.encode('utf-8') + b'\0' + stored_hash.encode('utf-8'),
+                                key=_verified_passwords_key).digest()
+    with _verified_passwords_lock:
+        if cache_key in _verified_passwords:
+            return True
+    
+    if stored_hash.startswith('$argon2'):
+        try:
+            valid = password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            valid = False
+    else:
+        valid = bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
+    
+    if valid:
+        with _verified_passwords_lock:
+            _verified_passwords[cache_key] = True
+    return valid
+
+# API keys are looked up by a keyed BLAKE2b-128 digest rather than their text
+_api_key_hash_key = hashlib.sha256(os.getenv('API_KEY_HASH_SECRET', app.secret_key).encode()).digest()
+
+def hash_api_key(api_key: str) -> bytes:
+    """16-byte keyed digest stored in users.api_key_hash"""
+    return hashlib.blake2b(api_key.encode(), key=_api_key_hash_key, digest_size=16).digest()
+
 # Database setup
+DB_PATH = 'llm_gateway.db'
+MICRO = 1_000_000  # costs are stored as integer micro-dollars
+SCHEMA_VERSION = 4  # bump whenever init_db() changes, so existing databases migrate
+
+# Applied once per connection; WAL lets readers run alongside the writer
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 MB page cache
+    "PRAGMA analysis_limit=400",  # ANALYZE samples each index instead of reading it all
+)
+
+# Only meaningful for a database file
+SQLITE_FILE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA mmap_size=268435456",
+)
+
+def _os_thread_local():
+    """threading.local() that stays per OS thread under gevent monkey-patching,
+    so a worker's greenlets share one connection instead of opening their own"""
+    try:
+        from gevent.monkey import get_original
+    except ImportError:
+        return threading.local()
+    return get_original('threading', 'local')()
+
+_db_local = _os_thread_local()
+
+# Serializes write transactions; under gevent this is a cooperative lock, which
+# keeps greenlets sharing a connection from interleaving their transactions
+_db_write_lock = threading.Lock()
+
+def get_db() -> sqlite3.Connection:
+    """Get the calling thread's SQLite connection, opening it on first use"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        # Autocommit mode: single statements commit on their own and
+        # multi-statement writes go through db_transaction()
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        pragmas = SQLITE_PRAGMAS if DB_PATH == ':memory:' else SQLITE_FILE_PRAGMAS + SQLITE_PRAGMAS
+        for pragma in pragmas:
+            conn.execute(pragma)
+        _db_local.conn = conn
+    return conn
+
+# Planner statistics are refreshed hourly by the background writer, between
+# batches and off the request path. analysis_limit keeps each ANALYZE to a
+# sample of every index, so it costs milliseconds however large the tables grow;
+# PRAGMA optimize would only cover tables the writer's own connection queried
+SQLITE_ANALYZE_INTERVAL = 3600  # seconds
+
+def analyze_db(conn: sqlite3.Connection):
+    """Refresh the query planner's statistics for every table"""
+    try:
+        with _db_write_lock:
+            conn.execute("ANALYZE")
+    except sqlite3.Error as e:
+        print(f"Warning: ANALYZE failed: {e}")
+
+@contextmanager
+def db_transaction():
+    """Run a group of writes as one BEGIN IMMEDIATE ... COMMIT block"""
+    conn = get_db()
+    with _db_write_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+            conn.execute("COMMIT")
+        except BaseException:
+            # A COMMIT that failed on a busy database leaves the transaction open
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+@app.teardown_appcontext
+def release_db(exc):
+    """Keep the thread's connection open for the next request, but never let a
+    transaction a view left open hold the write lock into it"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.execute("ROLLBACK")
+
+@atexit.register
+def close_db():
+    """Close the calling thread's connection (other threads' close with the thread)"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _db_local.conn = None
+
+def add_column_if_missing(c: sqlite3.Cursor, table: str, column: str, decl: str) -> bool:
+    """Add a column that an older database was created without"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column in {row[1] for row in c.fetchall()}:
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+def migrate_cost_column(c: sqlite3.Cursor, table: str, legacy: str, column: str):
+    """Convert an older database's REAL dollar column to integer micro-dollars"""
+    if add_column_if_missing(c, table, column, 'INTEGER DEFAULT 0'):
+        c.execute(f"UPDATE {table} SET {column} = CAST(ROUND({legacy} * {MICRO}) AS INTEGER) WHERE {legacy} IS NOT NULL")
+
 def init_db():
     """Initialize database with enhanced schema"""
+    c = get_db().cursor()
+    c.execute("PRAGMA user_version")
+    if c.fetchone()[0] == SCHEMA_VERSION:
+        return
     print("Initializing database...")
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
     
     # Enhanced users table
     c.execute('''CREATE TABLE IF NOT EXISTS users
@@ -122,6 +401,7 @@ def init_db():
                   email TEXT UNIQUE,
                   password_hash TEXT,
                   api_key TEXT UNIQUE, 
+                  api_key_hash BLOB,
                   subscription_tier TEXT DEFAULT 'free',
                   stripe_customer_id TEXT,
                   stripe_subscription_id TEXT,
@@ -140,11 +420,12 @@ def init_db():
                   provider TEXT,
                   model TEXT, 
                   tokens INTEGER, 
-                  cost REAL, 
+                  cost_micro INTEGER, 
                   endpoint TEXT,
                   response_time REAL,
                   timestamp TEXT,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
+    migrate_cost_column(c, 'usage_logs', 'cost', 'cost_micro')
     
     # Analytics aggregations table
     c.execute('''CREATE TABLE IF NOT EXISTS analytics_daily
@@ -152,9 +433,42 @@ def init_db():
                   user_id TEXT,
                   total_requests INTEGER DEFAULT 0,
                   total_tokens INTEGER DEFAULT 0,
-                  total_cost REAL DEFAULT 0,
-                  avg_response_time REAL DEFAULT 0,
+                  total_cost_micro INTEGER DEFAULT 0,
+                  sum_response_time REAL DEFAULT 0,
                   PRIMARY KEY (date, user_id))''')
+    migrate_cost_column(c, 'analytics_daily', 'total_cost', 'total_cost_micro')
+    # Older databases kept a running average; the average is now derived on read
+    if add_column_if_missing(c, 'analytics_daily', 'sum_response_time', 'REAL DEFAULT 0'):
+        c.execute("UPDATE analytics_daily SET sum_response_time = avg_response_time * total_requests")
+    
+    # Per-model daily aggregations, so dashboards don't scan usage_logs
+    c.execute('''CREATE TABLE IF NOT EXISTS analytics_model_daily
+                 (date TEXT,
+                  user_id TEXT,
+                  model TEXT,
+                  requests INTEGER DEFAULT 0,
+                  tokens INTEGER DEFAULT 0,
+                  cost_micro INTEGER DEFAULT 0,
+                  PRIMARY KEY (user_id, date, model))''')
+    migrate_cost_column(c, 'analytics_model_daily', 'cost', 'cost_micro')
+    
+    # Backfill it from existing logs the first time
+    c.execute("SELECT 1 FROM analytics_model_daily LIMIT 1")
+    if not c.fetchone():
+        c.execute("""INSERT INTO analytics_model_daily (date, user_id, model, requests, tokens, cost_micro)
+                     SELECT substr(timestamp, 1, 10), user_id, model, COUNT(*), SUM(tokens), SUM(cost_micro)
+                     FROM usage_logs GROUP BY 1, 2, 3""")
+    
+    # Site-wide daily totals for the admin panel, backfilled the same way
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_stats
+                 (day TEXT PRIMARY KEY,
+                  requests INTEGER DEFAULT 0,
+                  revenue_micro INTEGER DEFAULT 0)''')
+    c.execute("SELECT 1 FROM daily_stats LIMIT 1")
+    if not c.fetchone():
+        c.execute("""INSERT INTO daily_stats (day, requests, revenue_micro)
+                     SELECT substr(timestamp, 1, 10), COUNT(*), SUM(cost_micro)
+                     FROM usage_logs GROUP BY 1""")
     
     # Webhook events table
     c.execute('''CREATE TABLE IF NOT EXISTS webhook_events
@@ -173,125 +487,289 @@ def init_db():
                   user_id TEXT,
                   timestamp TEXT)''')
     
+    # Indexes for the per-user usage and analytics queries. users.api_key
+    # already has the index behind its UNIQUE constraint.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_usage_user_ts ON usage_logs (user_id, timestamp DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_usage_user_model_ts ON usage_logs (user_id, model, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_analytics_user_date ON analytics_daily (user_id, date DESC)")
+    # The admin panel's newest-first listings
+    c.execute("CREATE INDEX IF NOT EXISTS idx_usage_ts ON usage_logs (timestamp DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at DESC)")
+    
+    # Migrate older databases to hashed API key lookups; the hashes themselves
+    # are (re)computed by sync_api_key_hashes()
+    add_column_if_missing(c, 'users', 'api_key_hash', 'BLOB')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_api_key_hash ON users (api_key_hash)")
+    
+    # Small key/value store for settings that belong to the database
+    c.execute('''CREATE TABLE IF NOT EXISTS app_settings
+                 (name TEXT PRIMARY KEY,
+                  value BLOB)''')
+    
     # Create demo user if not exists
     demo_key = "demo_" + hashlib.md5("demo".encode()).hexdigest()[:16]
-    c.execute("SELECT * FROM users WHERE api_key = ?", (demo_key,))
+    c.execute("SELECT 1 FROM users WHERE api_key = ?", (demo_key,))
     if not c.fetchone():
         user_id = str(uuid.uuid4())
-        password_hash = bcrypt.hashpw("demo123".encode('utf-8'), bcrypt.gensalt())
+        password_hash = hash_password("demo123")
         now = datetime.now().isoformat()
         reset_date = (datetime.now() + timedelta(days=30)).isoformat()
         
         c.execute("""INSERT INTO users 
-                     (id, email, password_hash, api_key, subscription_tier, 
+                     (id, email, password_hash, api_key, api_key_hash, subscription_tier, 
                       tokens_included, tokens_used, tokens_reset_date, created_at, updated_at)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                 (user_id, "demo@example.com", password_hash.decode('utf-8'), 
-                  demo_key, "starter", 100000, 0, reset_date, now, now))
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (user_id, "demo@example.com", password_hash, 
+                  demo_key, hash_api_key(demo_key), "starter", 100000, 0, reset_date, now, now))
     
-    conn.commit()
-    conn.close()
+    c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     print("Database initialized successfully!")
 
+def sync_api_key_hashes():
+    """Recompute users.api_key_hash from the stored keys when the hash secret
+    has changed (e.g. a new API_KEY_HASH_SECRET or FLASK_SECRET_KEY)"""
+    fingerprint = hashlib.blake2b(b'api_key_hash', key=_api_key_hash_key, digest_size=16).digest()
+    with db_transaction() as c:
+        c.execute("SELECT value FROM app_settings WHERE name = 'api_key_hash_fingerprint'")
+        row = c.fetchone()
+        if row and row[0] == fingerprint:
+            return
+        c.execute("SELECT id, api_key FROM users WHERE api_key IS NOT NULL")
+        c.executemany("UPDATE users SET api_key_hash = ? WHERE id = ?",
+                      [(hash_api_key(api_key), user_id) for user_id, api_key in c.fetchall()])
+        c.execute("""INSERT INTO app_settings (name, value) VALUES ('api_key_hash_fingerprint', ?)
+                     ON CONFLICT(name) DO UPDATE SET value = excluded.value""", (fingerprint,))
+    print("API key hashes updated for the current hash secret")
+
 # Initialize database
 print("Starting InstaClaw...")
 try:
     init_db()
+    sync_api_key_hashes()
     print("✅ Database initialized successfully!")
 except Exception as e:
     print(f"⚠️  Database initialization warning: {e}")
     # Continue anyway - app can work without full database features
+finally:
+    # With gunicorn --preload this runs in the master; SQLite connections must
+    # not cross a fork, so each worker opens its own on first use
+    close_db()
+
+# Request coalescing: calls for the same (provider, model, max_tokens) that
+# arrive within BATCH_MAX_DELAY_MS are dispatched together. Identical prompts
+# share one upstream call; distinct ones go out concurrently on the pooled
+# connection.
+BATCH_MAX_SIZE = 32
+BATCH_MAX_DELAY_MS = 20
+LLM_MAX_TOKENS = 500
+
+class BatchScheduler:
+    """Dynamic batching of provider calls; lives on the background LLM loop"""
+    
+    def __init__(self, max_batch: int = BATCH_MAX_SIZE, max_delay_ms: int = BATCH_MAX_DELAY_MS):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queues = {}
+        self._tasks = set()  # the loop only keeps weak references to tasks
+    
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def submit(self, key: tuple, prompt: str, dispatch) -> Dict[str, Any]:
+        """Queue a prompt and wait for its result.
+        
+        dispatch(prompt, n) must return n results for n callers of the same prompt.
+        Only known models are coalesced: the model comes from the request body,
+        and each key keeps a queue and a consumer task for the life of the loop.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if key[1] not in COST_MICRO:
+            await self._dispatch_group(prompt, [future], dispatch)
+            return await future
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = asyncio.Queue()
+            self._spawn(self._consume(q, dispatch))
+        await q.put((prompt, future))
+        return await future
+    
+    async def _consume(self, q: asyncio.Queue, dispatch):
+        """Collect up to max_batch items or max_delay, then dispatch them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await q.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(q.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._spawn(self._dispatch(batch, dispatch))
+    
+    async def _dispatch(self, batch: list, dispatch):
+        """Send one upstream call per distinct prompt and fan results back out"""
+        groups = {}
+        for prompt, future in batch:
+            groups.setdefault(prompt, []).append(future)
+        await asyncio.gather(*(self._dispatch_group(prompt, futures, dispatch)
+                               for prompt, futures in groups.items()))
+    
+    async def _dispatch_group(self, prompt: str, futures: list, dispatch):
+        try:
+            results = await dispatch(prompt, len(futures))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+        # A short response must not leave the remaining callers waiting forever
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError(
+                    f"provider returned {len(results)} of {len(futures)} completions"))
+
+_batch_scheduler = None
+
+def get_batch_scheduler() -> BatchScheduler:
+    """Get the scheduler for the current background loop"""
+    get_llm_loop()
+    return _batch_scheduler
 
 # Real API integrations
 def call_openai_api(prompt: str, model: str = "gpt-3.5-turbo") -> Dict[str, Any]:
     """Real OpenAI API call"""
-    openai_client = get_openai_client()
-    if not openai_client or not getattr(openai_client, 'api_key', None):
+    client = get_openai_client()
+    if not client:
         return call_openai_mock(prompt, model)
-    
     try:
-        start_time = datetime.now()
-        response = openai_client.ChatCompletion.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=500
-        )
-        end_time = datetime.now()
-        
-        tokens = response['usage']['total_tokens']
-        cost = calculate_openai_cost(model, tokens)
-        
-        return {
-            "response": response['choices'][0]['message']['content'],
-            "tokens": tokens,
-            "cost": cost,
-            "model": model,
-            "response_time": (end_time - start_time).total_seconds(),
-            "provider": "openai"
-        }
+        return run_async(call_openai_api_async(client, prompt, model))
+    except TimeoutError:
+        print(f"OpenAI API error: no response after {LLM_CALL_TIMEOUT}s")
+        return call_openai_mock(prompt, model)
+
+async def call_openai_api_async(client, prompt: str, model: str) -> Dict[str, Any]:
+    """OpenAI API call on the background loop, coalesced with concurrent ones"""
+    try:
+        return await get_batch_scheduler().submit(
+            ('openai', model, LLM_MAX_TOKENS), prompt,
+            lambda prompt, n: openai_completions(client, model, prompt, n))
     except Exception as e:
         print(f"OpenAI API error: {e}")
         return call_openai_mock(prompt, model)
 
+async def openai_completions(client, model: str, prompt: str, n: int) -> list:
+    """One OpenAI request returning n independent completions of a prompt"""
+    t0 = time.monotonic()
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=LLM_MAX_TOKENS,
+        n=n
+    )
+    response_time = time.monotonic() - t0
+    
+    # Each caller is billed for the prompt plus its share of the completions
+    completion_share, remainder = divmod(response.usage.completion_tokens, n)
+    results = []
+    for i, choice in enumerate(response.choices):
+        tokens = response.usage.prompt_tokens + completion_share + (remainder if i == 0 else 0)
+        cost_micro = calculate_openai_cost(model, tokens)
+        results.append({
+            "response": choice.message.content,
+            "tokens": tokens,
+            "cost": cost_micro / MICRO,
+            "cost_micro": cost_micro,
+            "model": model,
+            "response_time": response_time,
+            "provider": "openai"
+        })
+    return results
+
 def call_anthropic_api(prompt: str, model: str = "claude-3-sonnet-20240229") -> Dict[str, Any]:
     """Real Anthropic API call"""
     client = get_anthropic_client()
     if not client:
         return call_claude_mock(prompt, model)
-    
     try:
-        start_time = datetime.now()
-        message = client.messages.create(
-            model=model,
-            max_tokens=500,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        end_time = datetime.now()
-        
-        tokens = message.usage.input_tokens + message.usage.output_tokens
-        cost = calculate_anthropic_cost(model, tokens)
-        
-        return {
-            "response": message.content[0].text,
-            "tokens": tokens,
-            "cost": cost,
-            "model": model,
-            "response_time": (end_time - start_time).total_seconds(),
-            "provider": "anthropic"
-        }
+        return run_async(call_anthropic_api_async(client, prompt, model))
+    except TimeoutError:
+        print(f"Anthropic API error: no response after {LLM_CALL_TIMEOUT}s")
+        return call_claude_mock(prompt, model)
+
+async def call_anthropic_api_async(client, prompt: str, model: str) -> Dict[str, Any]:
+    """Anthropic API call on the background loop, coalesced with concurrent ones"""
+    try:
+        return await get_batch_scheduler().submit(
+            ('anthropic', model, LLM_MAX_TOKENS), prompt,
+            lambda prompt, n: anthropic_completions(client, model, prompt, n))
     except Exception as e:
         print(f"Anthropic API error: {e}")
         return call_claude_mock(prompt, model)
 
-# Cost calculation functions
-def calculate_openai_cost(model: str, tokens: int) -> float:
-    """Calculate OpenAI API cost"""
-    rates = {
-        "gpt-4": 0.00003,
-        "gpt-3.5-turbo": 0.000002,
-        "gpt-4-turbo": 0.00001
-    }
-    return tokens * rates.get(model, 0.000002)
-
-def calculate_anthropic_cost(model: str, tokens: int) -> float:
-    """Calculate Anthropic API cost"""
-    rates = {
-        "claude-3-sonnet-20240229": 0.000015,
-        "claude-3-haiku-20240307": 0.000001,
-        "claude-3-opus-20240229": 0.000075
+async def anthropic_completions(client, model: str, prompt: str, n: int) -> list:
+    """n Anthropic completions of a prompt, sent concurrently (the API has no n)"""
+    return await asyncio.gather(*(anthropic_completion(client, model, prompt) for _ in range(n)))
+
+async def anthropic_completion(client, model: str, prompt: str) -> Dict[str, Any]:
+    """A single Anthropic messages call"""
+    t0 = time.monotonic()
+    message = await client.messages.create(
+        model=model,
+        max_tokens=LLM_MAX_TOKENS,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    response_time = time.monotonic() - t0
+    
+    tokens = message.usage.input_tokens + message.usage.output_tokens
+    cost_micro = calculate_anthropic_cost(model, tokens)
+    
+    return {
+        "response": message.content[0].text,
+        "tokens": tokens,
+        "cost": cost_micro / MICRO,
+        "cost_micro": cost_micro,
+        "model": model,
+        "response_time": response_time,
+        "provider": "anthropic"
     }
-    return tokens * rates.get(model, 0.000015)
+
+# Cost calculation functions - costs are integer micro-dollars so sums stay exact
+COST_MICRO = {
+    "gpt-4": 30,
+    "gpt-3.5-turbo": 2,
+    "gpt-4-turbo": 10,
+    "claude-3-sonnet-20240229": 15,
+    "claude-3-haiku-20240307": 1,
+    "claude-3-opus-20240229": 75
+}
+
+def calculate_openai_cost(model: str, tokens: int) -> int:
+    """Calculate OpenAI API cost in micro-dollars"""
+    return tokens * COST_MICRO.get(model, 2)
+
+def calculate_anthropic_cost(model: str, tokens: int) -> int:
+    """Calculate Anthropic API cost in micro-dollars"""
+    return tokens * COST_MICRO.get(model, 15)
 
 # Mock functions for fallback
 def call_openai_mock(prompt, model="gpt-3.5-turbo"):
     """Mock OpenAI API call"""
     tokens = len(prompt.split()) * 1.3
     response = f"[MOCK] This is a simulated response from {model} to: '{prompt[:50]}...'"
-    cost = calculate_openai_cost(model, int(tokens))
+    cost_micro = calculate_openai_cost(model, int(tokens))
     return {
         "response": response,
         "tokens": int(tokens),
-        "cost": round(cost, 6),
+        "cost": cost_micro / MICRO,
+        "cost_micro": cost_micro,
         "model": model,
         "response_time": 0.5,
         "provider": "openai"
@@ -301,11 +779,12 @@ def call_claude_mock(prompt, model="claude-3-sonnet-20240229"):
     """Mock Anthropic API call"""
     tokens = len(prompt.split()) * 1.2
     response = f"[MOCK] This is a simulated response from {model} to: '{prompt[:50]}...'"
-    cost = calculate_anthropic_cost(model, int(tokens))
+    cost_micro = calculate_anthropic_cost(model, int(tokens))
     return {
         "response": response,
         "tokens": int(tokens),
-        "cost": round(cost, 6),
+        "cost": cost_micro / MICRO,
+        "cost_micro": cost_micro,
         "model": model,
         "response_time": 0.7,
         "provider": "anthropic"
@@ -320,15 +799,81 @@ def generate_jwt(user_id: str) -> str:
     }
     return jwt.encode(payload, os.getenv('JWT_SECRET_KEY', app.secret_key), algorithm='HS256')
 
+# token -> (user_id, exp) for recently verified tokens; a hit is still checked
+# against the token's own expiry
+_jwt_cache = TTLCache(maxsize=8192, ttl=60)
+_jwt_cache_lock = threading.Lock()
+
 def verify_jwt(token: str) -> Optional[str]:
     """Verify JWT token"""
+    with _jwt_cache_lock:
+        hit = _jwt_cache.get(token)
+    if hit is not None and hit[1] > time.time():
+        return hit[0]
+    
     try:
         payload = jwt.decode(token, os.getenv('JWT_SECRET_KEY', app.secret_key), algorithms=['HS256'])
-        return payload['user_id']
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    
+    with _jwt_cache_lock:
+        _jwt_cache[token] = (payload['user_id'], payload['exp'])
+    return payload['user_id']
+
+# API key hash -> [id, subscription_tier, tokens_included, tokens_used, tokens_reset_date, is_active].
+# Entries are short-lived and token usage is written through, so a hit saves the
+# auth SELECT without letting the quota drift.
+_auth_cache = TTLCache(maxsize=10_000, ttl=30)
+_auth_cache_lock = threading.Lock()
+
+def lookup_api_key(key_hash: bytes) -> Optional[list]:
+    """Get the user row for a hashed API key, from cache when possible"""
+    with _auth_cache_lock:
+        user = _auth_cache.get(key_hash)
+    if user is not None:
+        return user
+    
+    c = get_db().cursor()
+    c.execute("""SELECT id, subscription_tier, tokens_included, tokens_used, 
+                       tokens_reset_date, is_active FROM users WHERE api_key_hash = ?""", (key_hash,))
+    row = c.fetchone()
+    if not row:
+        return None
+    
+    user = list(row)
+    with _auth_cache_lock:
+        _auth_cache[key_hash] = user
+    return user
+
+def record_token_usage(key_hash: bytes, tokens: int):
+    """Write token usage through to the cached user row"""
+    with _auth_cache_lock:
+        user = _auth_cache.get(key_hash)
+        if user is not None:
+            user[3] += tokens
+
+def invalidate_user_auth(user_id: str):
+    """Drop cached rows for a user, e.g. after a subscription change"""
+    with _auth_cache_lock:
+        for key in [k for k, user in _auth_cache.items() if user[0] == user_id]:
+            _auth_cache.pop(key, None)
+
+def reset_token_period(key_hash: bytes, now: datetime) -> list:
+    """Start a new billing period for an expired key and return the fresh row"""
+    row = get_db().execute("""UPDATE users SET tokens_used = 0, tokens_reset_date = ?
+                              WHERE api_key_hash = ? AND tokens_reset_date < ?
+                              RETURNING id, subscription_tier, tokens_included, tokens_used,
+                                        tokens_reset_date, is_active""",
+                           ((now + timedelta(days=30)).isoformat(), key_hash, now.isoformat())).fetchone()
+    with _auth_cache_lock:
+        if row:
+            user = _auth_cache[key_hash] = list(row)
+            return user
+        # Another worker already reset it, so our cached row is stale
+        _auth_cache.pop(key_hash, None)
+    return lookup_api_key(key_hash)
 
 def require_api_key(f):
     """API key authentication decorator"""
@@ -338,30 +883,18 @@ def require_api_key(f):
         if not api_key:
             return jsonify({"error": "API key required"}), 401
         
-        conn = sqlite3.connect('llm_gateway.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, subscription_tier, tokens_included, tokens_used, 
-                           tokens_reset_date, is_active FROM users WHERE api_key = ?""", (api_key,))
-        user = c.fetchone()
-        conn.close()
+        key_hash = hash_api_key(api_key)
+        user = lookup_api_key(key_hash)
         
         if not user or not user[5]:  # user[5] is is_active
             return jsonify({"error": "Invalid or inactive API key"}), 401
         
         # Check if tokens need to be reset
-        reset_date = datetime.fromisoformat(user[4])
-        if datetime.now() > reset_date:
-            # Reset tokens for new billing period
-            conn = sqlite3.connect('llm_gateway.db')
-            c = conn.cursor()
-            new_reset_date = (datetime.now() + timedelta(days=30)).isoformat()
-            c.execute("UPDATE users SET tokens_used = 0, tokens_reset_date = ? WHERE api_key = ?", 
-                     (new_reset_date, api_key))
-            conn.commit()
-            conn.close()
-            user = list(user)
-            user[3] = 0  # tokens_used
+        now = datetime.now()
+        if now > datetime.fromisoformat(user[4]):
+            user = reset_token_period(key_hash, now)
         
+        request.api_key_hash = key_hash
         request.user_id, request.tier, request.tokens_included, request.tokens_used = user[0], user[1], user[2], user[3]
         return f(*args, **kwargs)
     return decorated_function
@@ -386,24 +919,297 @@ def require_login(f):
 # Rate limiting based on subscription tier
 def get_rate_limit():
     """Get rate limit for current user"""
-    api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
-    if not api_key:
-        return "100/hour"  # Default limit
+    # require_api_key runs first and has already resolved the tier
+    tier = getattr(request, 'tier', None)
+    if tier is None:
+        api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
+        if not api_key:
+            return "100/hour"  # Default limit
+        user = lookup_api_key(hash_api_key(api_key))
+        tier = user[1] if user else None
     
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
-    c.execute("SELECT subscription_tier FROM users WHERE api_key = ?", (api_key,))
-    tier = c.fetchone()
-    conn.close()
+    return TIER_LIMIT.get(tier, "100/hour")
+
+RATE_LIMIT_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+def parse_rate_limit(limit: str) -> tuple:
+    """Turn '100/hour' into a (capacity, refill tokens per second) pair"""
+    count, period = limit.split('/')
+    capacity = int(count)
+    return capacity, capacity / RATE_LIMIT_PERIODS[period.strip()]
+
+# Token bucket kept in a Redis hash {tokens, ts}: one atomic round-trip per
+# request. Returns {allowed, retry_after_ms}.
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+local allowed, retry_after = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate))
+return {allowed, retry_after}
+"""
+
+# register_script runs EVALSHA and reloads the script if Redis lost it
+_token_bucket_script = redis_client.register_script(TOKEN_BUCKET_LUA) if redis_client else None
+
+# In-process buckets, used when Redis is unavailable
+_local_buckets = {}
+_local_buckets_lock = threading.Lock()
+
+# Keys that were just refused -> (refuse locally until, retry at), both monotonic,
+# so clients hammering through a 429 don't cost a Redis round-trip each
+_recent_refusals = {}
+
+def _take_local_token(key: str, capacity: int, rate: float) -> tuple:
+    """In-process equivalent of TOKEN_BUCKET_LUA"""
+    now = time.monotonic()
+    with _local_buckets_lock:
+        tokens, ts = _local_buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        if tokens >= 1:
+            _local_buckets[key] = (tokens - 1, now)
+            return True, 0
+        _local_buckets[key] = (tokens, now)
+    return False, int((1 - tokens) * 1000 / rate) + 1
+
+def take_rate_limit_token(key: str, capacity: int, rate: float) -> tuple:
+    """Take one token from a bucket; returns (allowed, retry_after_ms)"""
+    if _token_bucket_script is not None:
+        try:
+            allowed, retry_after = _token_bucket_script(
+                keys=[key], args=[capacity, rate, int(time.time() * 1000)])
+            return bool(allowed), int(retry_after)
+        except redis.RedisError as e:
+            print(f"Warning: Redis rate limiting failed, using local bucket: {e}")
+    return _take_local_token(key, capacity, rate)
+
+def rate_limit(f):
+    """Per-user token bucket rate limiting, sized by subscription tier"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = f"rl:{request.user_id}"
+        now = time.monotonic()
+        
+        refusal = _recent_refusals.get(key)
+        if refusal is not None and now >= refusal[0]:
+            _recent_refusals.pop(key, None)
+            refusal = None
+        
+        if refusal is None:
+            capacity, rate = parse_rate_limit(get_rate_limit())
+            allowed, retry_after_ms = take_rate_limit_token(key, capacity, rate)
+            if allowed:
+                return f(*args, **kwargs)
+            retry_after_s = retry_after_ms / 1000
+            refusal = (now + min(retry_after_s, 1.0), now + retry_after_s)
+            _recent_refusals[key] = refusal
+        
+        retry_after = max(1, math.ceil(refusal[1] - now))
+        response = jsonify({"error": "Rate limit exceeded", "retry_after": retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    return decorated_function
+
+# Usage accounting statements, kept at module level so the connection's
+# statement cache reuses the compiled programs
+SQL_INSERT_USAGE_LOG = """INSERT INTO usage_logs 
+                          (user_id, provider, model, tokens, cost_micro, endpoint, response_time, timestamp)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+SQL_UPDATE_USER_TOKENS = "UPDATE users SET tokens_used = tokens_used + ?, updated_at = ? WHERE id = ?"
+
+SQL_UPSERT_ANALYTICS_DAILY = """INSERT INTO analytics_daily 
+                                (date, user_id, total_requests, total_tokens, total_cost_micro, sum_response_time)
+                                VALUES (?, ?, 1, ?, ?, ?)
+                                ON CONFLICT(date, user_id) DO UPDATE SET
+                                    total_requests = total_requests + 1,
+                                    total_tokens = total_tokens + excluded.total_tokens,
+                                    total_cost_micro = total_cost_micro + excluded.total_cost_micro,
+                                    sum_response_time = sum_response_time + excluded.sum_response_time"""
+
+SQL_UPSERT_ANALYTICS_MODEL_DAILY = """INSERT INTO analytics_model_daily 
+                                      (date, user_id, model, requests, tokens, cost_micro)
+                                      VALUES (?, ?, ?, 1, ?, ?)
+                                      ON CONFLICT(user_id, date, model) DO UPDATE SET
+                                          requests = requests + 1,
+                                          tokens = tokens + excluded.tokens,
+                                          cost_micro = cost_micro + excluded.cost_micro"""
+
+SQL_UPSERT_DAILY_STATS = """INSERT INTO daily_stats (day, requests, revenue_micro)
+                            VALUES (?, 1, ?)
+                            ON CONFLICT(day) DO UPDATE SET
+                                requests = requests + 1,
+                                revenue_micro = revenue_micro + excluded.revenue_micro"""
+
+# Background usage writer - accounting writes are batched off the request path
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_WINDOW = 0.05  # seconds to keep collecting after the first item
+WRITE_RETRY_ATTEMPTS = 10   # a locked database is retried after 0.1, 0.2, 0.4, ... seconds
+WRITE_RETRY_MAX_DELAY = 5
+
+_write_q = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def enqueue_write(*item):
+    """Queue a write for the background writer, starting it if needed"""
+    global _writer_thread
+    if _writer_thread is None or not _writer_thread.is_alive():
+        with _writer_lock:
+            if _writer_thread is None or not _writer_thread.is_alive():
+                _writer_thread = threading.Thread(target=_writer, name='usage-writer', daemon=True)
+                _writer_thread.start()
+    _write_q.put(item)
+
+def _drain(q: queue.Queue, max_items: int, timeout: float) -> list:
+    """Block for one item, then collect more until max_items or timeout"""
+    batch = [q.get()]
+    deadline = time.monotonic() + timeout
+    while len(batch) < max_items:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(q.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+# Webhook events that change a user; the rest are only logged
+STRIPE_HANDLED_EVENTS = {'checkout.session.completed'}
+
+# Failed events are retried after 1, 2, 4, ... seconds (capped); after the last
+# attempt the row stays unprocessed for a redelivery or the next writer start
+STRIPE_EVENT_MAX_ATTEMPTS = 8
+STRIPE_EVENT_MAX_DELAY = 300
+
+def retry_stripe_event(event_id: str, attempt: int):
+    """Queue a failed event again after an exponential backoff"""
+    if attempt + 1 >= STRIPE_EVENT_MAX_ATTEMPTS:
+        print(f"Stripe event {event_id} failed {STRIPE_EVENT_MAX_ATTEMPTS} times, leaving it unprocessed")
+        return
+    timer = threading.Timer(min(2 ** attempt, STRIPE_EVENT_MAX_DELAY), enqueue_write,
+                            ('stripe_event', event_id, attempt + 1))
+    timer.daemon = True
+    timer.start()
+
+def process_stripe_event(event_id: str):
+    """Apply a stored webhook event to its user and mark it processed"""
+    c = get_db().cursor()
+    c.execute("SELECT event_type, payload FROM webhook_events WHERE id = ? AND NOT processed", (event_id,))
+    row = c.fetchone()
+    if not row:
+        return
+    
+    tier = user_id = None
+    if row[0] == 'checkout.session.completed':
+        checkout = orjson.loads(row[1])['object']
+        user_id = checkout['client_reference_id']
+        
+        # Get subscription details from Stripe
+        subscription = stripe.Subscription.retrieve(checkout['subscription'])
+        tier = PRICE_TO_TIER.get(subscription['items']['data'][0]['price']['id'])
+    
+    with db_transaction() as c:
+        if tier:
+            c.execute("""UPDATE users SET subscription_tier = ?, 
+                                          stripe_customer_id = ?,
+                                          stripe_subscription_id = ?,
+                                          tokens_included = ?,
+                                          updated_at = ?
+                         WHERE id = ?""",
+                     (tier, checkout['customer'], checkout['subscription'],
+                      SUBSCRIPTION_TIERS[tier]['tokens_per_month'],
+                      datetime.now().isoformat(), user_id))
+        c.execute("UPDATE webhook_events SET processed = 1, user_id = ? WHERE id = ?", (user_id, event_id))
     
     if tier:
-        return SUBSCRIPTION_TIERS.get(tier[0], {}).get('rate_limit', '100/hour')
-    return "100/hour"
+        invalidate_user_auth(user_id)
+
+def _write_batch(batch: list):
+    """Commit a batch of queued writes in a single transaction"""
+    logs, token_updates, daily, model_daily, site_daily, stripe_events = [], [], [], [], [], []
+    for item in batch:
+        if item[0] == 'stripe_event':
+            stripe_events.append(item[1:])
+        elif item[0] == 'usage':
+            _, user_id, endpoint, result, timestamp, today = item
+            logs.append((user_id, result['provider'], result['model'], result['tokens'],
+                         result['cost_micro'], endpoint, result['response_time'], timestamp))
+            token_updates.append((result['tokens'], timestamp, user_id))
+            daily.append((today, user_id, result['tokens'], result['cost_micro'], result['response_time']))
+            model_daily.append((today, user_id, result['model'], result['tokens'], result['cost_micro']))
+            site_daily.append((today, result['cost_micro']))
+    
+    with db_transaction() as c:
+        c.executemany(SQL_INSERT_USAGE_LOG, logs)
+        c.executemany(SQL_UPDATE_USER_TOKENS, token_updates)
+        c.executemany(SQL_UPSERT_ANALYTICS_DAILY, daily)
+        c.executemany(SQL_UPSERT_ANALYTICS_MODEL_DAILY, model_daily)
+        c.executemany(SQL_UPSERT_DAILY_STATS, site_daily)
+    
+    # Stripe calls are slow, so they go after the usage commit
+    for event_id, attempt in stripe_events:
+        try:
+            process_stripe_event(event_id)
+        except Exception as e:
+            print(f"Stripe event {event_id} failed: {e}")
+            retry_stripe_event(event_id, attempt)
+
+def _write_batch_with_retry(batch: list):
+    """Commit a batch, retrying with backoff while the database is locked or busy"""
+    for attempt in range(WRITE_RETRY_ATTEMPTS):
+        try:
+            return _write_batch(batch)
+        except sqlite3.OperationalError as e:
+            # The usage transaction rolled back before any Stripe event ran,
+            # so the whole batch can be replayed
+            if attempt + 1 == WRITE_RETRY_ATTEMPTS:
+                raise
+            print(f"Usage writer error, retrying: {e}")
+            time.sleep(min(0.1 * 2 ** attempt, WRITE_RETRY_MAX_DELAY))
+
+def _writer():
+    """Background writer loop"""
+    # Pick up webhook events left unprocessed by a previous run
+    for (event_id,) in get_db().execute("SELECT id FROM webhook_events WHERE NOT processed").fetchall():
+        _write_q.put(('stripe_event', event_id, 0))
+    analyzed_at = time.monotonic()
+    while True:
+        batch = _drain(_write_q, WRITE_BATCH_SIZE, WRITE_BATCH_WINDOW)
+        try:
+            _write_batch_with_retry(batch)
+        except Exception as e:
+            print(f"Usage writer error: {e}")
+        finally:
+            for _ in batch:
+                _write_q.task_done()
+        if time.monotonic() - analyzed_at > SQLITE_ANALYZE_INTERVAL:
+            analyzed_at = time.monotonic()
+            analyze_db(get_db())
+
+@atexit.register
+def flush_writes():
+    """Block until every queued write has been committed"""
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _write_q.join()
 
 # API Routes
 @app.route('/api/chat', methods=['POST'])
 @require_api_key
-@limiter.limit(get_rate_limit)
+@rate_limit
 def chat():
     """Enhanced unified chat endpoint"""
     data = request.get_json()
@@ -431,36 +1237,11 @@ def chat():
         # Auto-routing based on cost/performance
         result = call_openai_api(prompt, 'gpt-3.5-turbo')  # Default to cost-effective option
     
-    # Log usage
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
-    
-    # Insert detailed usage log
-    c.execute("""INSERT INTO usage_logs 
-                 (user_id, provider, model, tokens, cost, endpoint, response_time, timestamp)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-             (request.user_id, result['provider'], result['model'], result['tokens'], 
-              result['cost'], '/api/chat', result['response_time'], datetime.now().isoformat()))
-    
-    # Update user token usage
+    # Log usage in the background; the quota figures below don't wait for it
+    now = datetime.now()
+    enqueue_write('usage', request.user_id, '/api/chat', result, now.isoformat(), now.strftime('%Y-%m-%d'))
+    record_token_usage(request.api_key_hash, result['tokens'])
     new_usage = request.tokens_used + result['tokens']
-    c.execute("UPDATE users SET tokens_used = ?, updated_at = ? WHERE id = ?", 
-             (new_usage, datetime.now().isoformat(), request.user_id))
-    
-    # Update daily analytics
-    today = datetime.now().strftime('%Y-%m-%d')
-    c.execute("""INSERT OR REPLACE INTO analytics_daily 
-                 (date, user_id, total_requests, total_tokens, total_cost, avg_response_time)
-                 VALUES (?, ?, 
-                         COALESCE((SELECT total_requests FROM analytics_daily WHERE date = ? AND user_id = ?), 0) + 1,
-                         COALESCE((SELECT total_tokens FROM analytics_daily WHERE date = ? AND user_id = ?), 0) + ?,
-                         COALESCE((SELECT total_cost FROM analytics_daily WHERE date = ? AND user_id = ?), 0) + ?,
-                         ?)""",
-             (today, request.user_id, today, request.user_id, today, request.user_id, 
-              result['tokens'], today, request.user_id, result['cost'], result['response_time']))
-    
-    conn.commit()
-    conn.close()
     
     return jsonify({
         "response": result['response'],
@@ -490,11 +1271,9 @@ def register():
             return render_template('auth/register.html')
         
         # Check if user exists
-        conn = sqlite3.connect('llm_gateway.db')
-        c = conn.cursor()
+        c = get_db().cursor()
         c.execute("SELECT id FROM users WHERE email = ?", (email,))
         if c.fetchone():
-            conn.close()
             if request.is_json:
                 return jsonify({"error": "Email already registered"}), 400
             flash("Email already registered")
@@ -502,19 +1281,18 @@ def register():
         
         # Create user
         user_id = str(uuid.uuid4())
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        api_key = "sk_" + hashlib.md5((email + str(datetime.now())).encode()).hexdigest()
-        now = datetime.now().isoformat()
-        reset_date = (datetime.now() + timedelta(days=30)).isoformat()
+        password_hash = hash_password(password)
+        api_key = "sk_" + secrets.token_hex(16)
+        now = datetime.now()
+        now_iso = now.isoformat()
+        reset_date = (now + timedelta(days=30)).isoformat()
         
         c.execute("""INSERT INTO users 
-                     (id, email, password_hash, api_key, subscription_tier, 
+                     (id, email, password_hash, api_key, api_key_hash, subscription_tier, 
                       tokens_included, tokens_used, tokens_reset_date, created_at, updated_at)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                 (user_id, email, password_hash.decode('utf-8'), api_key, 
-                  "free", SUBSCRIPTION_TIERS["free"]["tokens_per_month"], 0, reset_date, now, now))
-        conn.commit()
-        conn.close()
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (user_id, email, password_hash, api_key, hash_api_key(api_key), 
+                  "free", SUBSCRIPTION_TIERS["free"]["tokens_per_month"], 0, reset_date, now_iso, now_iso))
         
         if request.is_json:
             return jsonify({"message": "Registration successful", "api_key": api_key}), 201
@@ -542,18 +1320,20 @@ def login():
             return render_template('auth/login.html')
         
         # Verify user
-        conn = sqlite3.connect('llm_gateway.db')
-        c = conn.cursor()
+        c = get_db().cursor()
         c.execute("SELECT id, password_hash, is_active FROM users WHERE email = ?", (email,))
         user = c.fetchone()
-        conn.close()
         
-        if not user or not bcrypt.checkpw(password.encode('utf-8'), user[1].encode('utf-8')):
+        if not user or not verify_password(password, user[1]):
             if request.is_json:
                 return jsonify({"error": "Invalid credentials"}), 401
             flash("Invalid email or password")
             return render_template('auth/login.html')
         
+        # Move legacy bcrypt rows to argon2id while we have the plaintext
+        if not user[1].startswith('$argon2'):
+            c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hash_password(password), user[0]))
+        
         if not user[2]:  # is_active
             if request.is_json:
                 return jsonify({"error": "Account deactivated"}), 401
@@ -572,7 +1352,10 @@ def login():
 @app.route('/auth/logout')
 def logout():
     """User logout"""
-    session.pop('jwt_token', None)
+    token = session.pop('jwt_token', None)
+    if token:
+        with _jwt_cache_lock:
+            _jwt_cache.pop(token, None)
     flash("Logged out successfully")
     return redirect(url_for('login'))
 
@@ -581,17 +1364,16 @@ def logout():
 @require_login
 def billing():
     """Billing dashboard"""
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     c.execute("""SELECT subscription_tier, stripe_customer_id, stripe_subscription_id, 
                         tokens_included, tokens_used, tokens_reset_date 
                  FROM users WHERE id = ?""", (request.current_user_id,))
     user_data = c.fetchone()
-    conn.close()
     
     return render_template('billing.html', 
                          user_data=user_data,
                          subscription_tiers=SUBSCRIPTION_TIERS,
+                         subscription_tiers_json=SUBSCRIPTION_TIERS_JSON,
                          stripe_pk=os.getenv('STRIPE_PUBLISHABLE_KEY'))
 
 @app.route('/create-checkout-session', methods=['POST'])
@@ -642,47 +1424,23 @@ def stripe_webhook():
     except stripe.error.SignatureVerificationError:
         return '', 400
     
-    # Handle different event types
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        user_id = session['client_reference_id']
-        
-        # Update user subscription
-        conn = sqlite3.connect('llm_gateway.db')
-        c = conn.cursor()
-        
-        # Get subscription details from Stripe
-        subscription = stripe.Subscription.retrieve(session['subscription'])
-        price_id = subscription['items']['data'][0]['price']['id']
-        
-        # Map price_id to tier
-        tier = None
-        for tier_name, tier_data in SUBSCRIPTION_TIERS.items():
-            if tier_data.get('stripe_price_id') == price_id:
-                tier = tier_name
-                break
-        
-        if tier:
-            c.execute("""UPDATE users SET subscription_tier = ?, 
-                                          stripe_customer_id = ?,
-                                          stripe_subscription_id = ?,
-                                          tokens_included = ?,
-                                          updated_at = ?
-                         WHERE id = ?""",
-                     (tier, session['customer'], session['subscription'],
-                      SUBSCRIPTION_TIERS[tier]['tokens_per_month'],
-                      datetime.now().isoformat(), user_id))
-            conn.commit()
-        conn.close()
-    
-    # Log webhook event
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO webhook_events (id, event_type, payload, created_at) VALUES (?, ?, ?, ?)",
-             (event['id'], event['type'], json.dumps(event['data']), datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+    # Persist the event and acknowledge it right away; the background writer
+    # does the Stripe round-trip. The primary key dedupes redeliveries.
+    try:
+        with db_transaction() as c:
+            c.execute("""INSERT INTO webhook_events (id, event_type, payload, processed, created_at)
+                         VALUES (?, ?, ?, ?, ?)""",
+                      (event['id'], event['type'], orjson.dumps(event['data']).decode(),
+                       event['type'] not in STRIPE_HANDLED_EVENTS, datetime.now().isoformat()))
+    except sqlite3.IntegrityError:
+        # A redelivery; queue it again if our earlier attempt hasn't succeeded
+        row = get_db().execute("SELECT processed FROM webhook_events WHERE id = ?", (event['id'],)).fetchone()
+        if row and not row[0]:
+            enqueue_write('stripe_event', event['id'], 0)
+        return '', 200
     
+    if event['type'] in STRIPE_HANDLED_EVENTS:
+        enqueue_write('stripe_event', event['id'], 0)
     return '', 200
 
 # Analytics dashboard
@@ -690,33 +1448,31 @@ def stripe_webhook():
 @require_login
 def analytics():
     """Analytics dashboard"""
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     
     # Get user analytics
-    c.execute("""SELECT date, total_requests, total_tokens, total_cost, avg_response_time
+    c.execute("""SELECT date, total_requests, total_tokens, total_cost_micro / 1e6,
+                        sum_response_time / total_requests
                  FROM analytics_daily 
                  WHERE user_id = ? 
                  ORDER BY date DESC LIMIT 30""", (request.current_user_id,))
     daily_stats = c.fetchall()
     
     # Get model usage breakdown
-    c.execute("""SELECT model, COUNT(*) as requests, SUM(tokens) as tokens, SUM(cost) as cost
-                 FROM usage_logs 
-                 WHERE user_id = ? AND timestamp >= date('now', '-30 days')
+    c.execute("""SELECT model, SUM(requests) as requests, SUM(tokens) as tokens, SUM(cost_micro) / 1e6 as cost
+                 FROM analytics_model_daily 
+                 WHERE user_id = ? AND date >= date('now', '-30 days')
                  GROUP BY model
                  ORDER BY requests DESC""", (request.current_user_id,))
     model_stats = c.fetchall()
     
     # Get recent usage
-    c.execute("""SELECT model, tokens, cost, timestamp, response_time
+    c.execute("""SELECT model, tokens, cost_micro / 1e6, timestamp, response_time
                  FROM usage_logs 
                  WHERE user_id = ? 
                  ORDER BY timestamp DESC LIMIT 50""", (request.current_user_id,))
     recent_usage = c.fetchall()
     
-    conn.close()
-    
     return render_template('analytics.html', 
                          daily_stats=daily_stats,
                          model_stats=model_stats,
@@ -728,43 +1484,42 @@ def api_docs():
     """API documentation"""
     return render_template('api_docs.html')
 
-@app.route('/docs/api')
-def api_docs_json():
-    """OpenAPI specification"""
-    spec = {
-        "openapi": "3.0.0",
-        "info": {
-            "title": "InstaClaw API",
-            "version": "1.0.0",
-            "description": "Unified API for accessing multiple LLM providers"
-        },
-        "servers": [
-            {"url": request.url_root, "description": "Production server"}
-        ],
-        "paths": {
-            "/api/chat": {
-                "post": {
-                    "summary": "Generate text completion",
-                    "parameters": [
-                        {
-                            "name": "X-API-Key",
-                            "in": "header",
-                            "required": True,
-                            "schema": {"type": "string"}
-                        }
-                    ],
-                    "requestBody": {
-                        "content": {
-                            "application/json": {
-                                "schema": {
-                                    "type": "object",
-                                    "properties": {
-                                        "prompt": {"type": "string"},
-                                        "model": {"type": "string", "default": "auto"},
-                                        "provider": {"type": "string", "default": "auto"}
-                                    },
-                                    "required": ["prompt"]
-                                }
+# OpenAPI spec, serialized once at import; only the server URL depends on the
+# request and is spliced in where the placeholder was
+_API_SPEC_URL_PLACEHOLDER = '__URLROOT__'
+API_SPEC = {
+    "openapi": "3.0.0",
+    "info": {
+        "title": "InstaClaw API",
+        "version": "1.0.0",
+        "description": "Unified API for accessing multiple LLM providers"
+    },
+    "servers": [
+        {"url": _API_SPEC_URL_PLACEHOLDER, "description": "Production server"}
+    ],
+    "paths": {
+        "/api/chat": {
+            "post": {
+                "summary": "Generate text completion",
+                "parameters": [
+                    {
+                        "name": "X-API-Key",
+                        "in": "header",
+                        "required": True,
+                        "schema": {"type": "string"}
+                    }
+                ],
+                "requestBody": {
+                    "content": {
+                        "application/json": {
+                            "schema": {
+                                "type": "object",
+                                "properties": {
+                                    "prompt": {"type": "string"},
+                                    "model": {"type": "string", "default": "auto"},
+                                    "provider": {"type": "string", "default": "auto"}
+                                },
+                                "required": ["prompt"]
                             }
                         }
                     }
@@ -772,7 +1527,15 @@ def api_docs_json():
             }
         }
     }
-    return jsonify(spec)
+}
+
+_API_SPEC_PREFIX, _API_SPEC_SUFFIX = orjson.dumps(API_SPEC).split(_API_SPEC_URL_PLACEHOLDER.encode())
+
+@app.route('/docs/api')
+def api_docs_json():
+    """OpenAPI specification"""
+    url_root = orjson.dumps(request.url_root)[1:-1]  # JSON-escaped, without quotes
+    return Response(_API_SPEC_PREFIX + url_root + _API_SPEC_SUFFIX, mimetype='application/json')
 
 # Web Interface Routes
 @app.route('/')
@@ -786,8 +1549,7 @@ def dashboard():
         session.pop('jwt_token', None)
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     
     # Get user info
     c.execute("""SELECT email, subscription_tier, tokens_included, tokens_used, 
@@ -795,21 +1557,19 @@ def dashboard():
     user_data = c.fetchone()
     
     # Get recent usage stats
-    c.execute("""SELECT COUNT(*) as requests, SUM(tokens) as tokens, SUM(cost) as cost
-                 FROM usage_logs 
-                 WHERE user_id = ? AND timestamp >= date('now', '-7 days')""", (user_id,))
+    c.execute("""SELECT SUM(total_requests) as requests, SUM(total_tokens) as tokens, SUM(total_cost_micro) / 1e6 as cost
+                 FROM analytics_daily 
+                 WHERE user_id = ? AND date >= date('now', '-7 days')""", (user_id,))
     weekly_stats = c.fetchone()
     
     # Get model breakdown
-    c.execute("""SELECT model, COUNT(*) as requests
-                 FROM usage_logs 
-                 WHERE user_id = ? AND timestamp >= date('now', '-7 days')
+    c.execute("""SELECT model, SUM(requests) as requests
+                 FROM analytics_model_daily 
+                 WHERE user_id = ? AND date >= date('now', '-7 days')
                  GROUP BY model
                  ORDER BY requests DESC LIMIT 5""", (user_id,))
     model_breakdown = c.fetchall()
     
-    conn.close()
-    
     return render_template('dashboard.html', 
                          user_data=user_data,
                          weekly_stats=weekly_stats,
@@ -822,6 +1582,19 @@ def test_interface():
     """Enhanced test interface"""
     return render_template('test.html')
 
+# Admin panel queries
+SQL_ADMIN_STATS = """SELECT (SELECT COUNT(*) FROM users), requests, revenue_micro / 1e6
+                     FROM (SELECT 1) LEFT JOIN daily_stats ON day = ?"""
+
+SQL_ADMIN_USERS = """SELECT id, email, subscription_tier, tokens_included, tokens_used, 
+                            created_at, is_active FROM users ORDER BY created_at DESC LIMIT 50"""
+
+SQL_ADMIN_RECENT_USAGE = """SELECT u.email, ul.model, ul.tokens, ul.cost_micro / 1e6, ul.timestamp 
+                            FROM (SELECT user_id, model, tokens, cost_micro, timestamp
+                                  FROM usage_logs ORDER BY timestamp DESC LIMIT 100) ul 
+                            JOIN users u ON ul.user_id = u.id 
+                            ORDER BY ul.timestamp DESC"""
+
 @app.route('/admin')
 def admin():
     """Enhanced admin panel"""
@@ -829,33 +1602,21 @@ def admin():
     if not session.get('jwt_token'):
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     
     # Get system stats
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM usage_logs WHERE timestamp >= date('now', '-1 day')")
-    daily_requests = c.fetchone()[0]
-    
-    c.execute("SELECT SUM(cost) FROM usage_logs WHERE timestamp >= date('now', '-1 day')")
-    daily_revenue = c.fetchone()[0] or 0
+    c.execute(SQL_ADMIN_STATS, (datetime.now().strftime('%Y-%m-%d'),))
+    total_users, daily_requests, daily_revenue = c.fetchone()
+    daily_requests, daily_revenue = daily_requests or 0, daily_revenue or 0
     
     # Get all users
-    c.execute("""SELECT id, email, subscription_tier, tokens_included, tokens_used, 
-                        created_at, is_active FROM users ORDER BY created_at DESC LIMIT 50""")
+    c.execute(SQL_ADMIN_USERS)
     users = c.fetchall()
     
     # Get recent usage
-    c.execute("""SELECT u.email, ul.model, ul.tokens, ul.cost, ul.timestamp 
-                 FROM usage_logs ul 
-                 JOIN users u ON ul.user_id = u.id 
-                 ORDER BY ul.timestamp DESC LIMIT 100""")
+    c.execute(SQL_ADMIN_RECENT_USAGE)
     usage = c.fetchall()
     
-    conn.close()
-    
     return render_template('admin.html', 
                          users=users, 
                          usage=usage,
@@ -894,6 +1655,10 @@ def community():
     """Community page"""
     return render_template('community.html')
 
+# Every mocked tool call is billed the same
+OPENCLAW_MOCK_TOKENS = 10
+OPENCLAW_MOCK_COST_MICRO = 100
+
 @app.route('/api/openclaw', methods=['POST'])
 @require_api_key
 @limiter.limit("100 per hour")
@@ -904,46 +1669,30 @@ def openclaw_unified():
     if not data or 'tools' not in data:
         return jsonify({"error": "Tools array required"}), 400
     
-    results = []
-    total_tokens = 0
-    total_cost = 0
-    
-    for tool_request in data['tools']:
-        tool_name = tool_request.get('tool')
-        if not tool_name:
-            continue
-            
-        # Mock execution - in production this would route to actual OpenClaw tools
-        mock_result = {
-            "tool": tool_name,
-            "success": True,
-            "data": f"Mock result from {tool_name}",
-            "tokens": 10,
-            "cost": 0.0001
-        }
-        
-        results.append(mock_result)
-        total_tokens += mock_result['tokens']
-        total_cost += mock_result['cost']
-    
-    # Log usage
-    conn = sqlite3.connect('llm_gateway.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO usage_logs (user_id, provider, model, tokens, cost, endpoint, response_time, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-             (request.user_id, "openclaw", "unified-api", total_tokens, total_cost, "openclaw_unified", 1.2, datetime.now().isoformat()))
-    
-    # Update user token usage
-    c.execute("UPDATE users SET tokens_used = tokens_used + ? WHERE id = ?", 
-              (total_tokens, request.user_id))
+    # Mock execution - in production this would route to actual OpenClaw tools
+    names = [t.get('tool') for t in data['tools'] if t.get('tool')]
+    results = [{
+        "tool": name,
+        "success": True,
+        "data": f"Mock result from {name}",
+        "tokens": OPENCLAW_MOCK_TOKENS,
+        "cost": OPENCLAW_MOCK_COST_MICRO / MICRO
+    } for name in names]
+    total_tokens = len(names) * OPENCLAW_MOCK_TOKENS
+    total_cost_micro = len(names) * OPENCLAW_MOCK_COST_MICRO
     
-    conn.commit()
-    conn.close()
+    # Log usage in the background
+    now = datetime.now()
+    usage = {"provider": "openclaw", "model": "unified-api", "tokens": total_tokens,
+             "cost_micro": total_cost_micro, "response_time": 1.2}
+    enqueue_write('usage', request.user_id, 'openclaw_unified', usage, now.isoformat(), now.strftime('%Y-%m-%d'))
+    record_token_usage(request.api_key_hash, total_tokens)
     
     return jsonify({
         "results": results,
         "execution_time": 1.2,
         "tokens_used": total_tokens,
-        "cost": total_cost
+        "cost": total_cost_micro / MICRO
     })
 
 # Health check endpoint
@@ -971,6 +1720,47 @@ def ping():
     """Ultra-simple ping endpoint"""
     return "pong", 200
 
+# Health checks are answered at the WSGI layer so the platform's probes skip
+# Flask's routing and context push; the routes above remain as fallbacks
+class FastHealth:
+    """WSGI middleware serving GET /ping and /health before Flask"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.health_prefix, self.health_suffix = orjson.dumps({
+            "status": "healthy",
+            "timestamp": "__TIMESTAMP__",
+            "version": "1.0.0",
+            "environment": os.getenv('RAILWAY_ENVIRONMENT', 'local')
+        }).split(b'"__TIMESTAMP__"')
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'GET':
+            return self.wsgi_app(environ, start_response)
+        path = environ.get('PATH_INFO')
+        if path == '/ping':
+            body, content_type = b'pong', 'text/html; charset=utf-8'
+        elif path == '/health':
+            body = self.health_prefix + orjson.dumps(datetime.now().isoformat()) + self.health_suffix
+            content_type = 'application/json'
+        else:
+            return self.wsgi_app(environ, start_response)
+        # Same origin policy as CORS(app) for these credential-free responses
+        start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body))),
+                                  ('Access-Control-Allow-Origin', '*')])
+        return [body]
+
+app.wsgi_app = FastHealth(app.wsgi_app)
+
+# Compile every template up front - in the gunicorn master under --preload, so
+# workers inherit them - with the bytecode kept on disk across restarts
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+for template_name in app.jinja_env.list_templates():
+    try:
+        app.jinja_env.get_template(template_name)
+    except TemplateError as e:
+        print(f"Warning: template {template_name} failed to compile: {e}")
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     host = os.getenv('HOST', '0.0.0.0')
@@ -0,0 +1,36 @@
+"""
+Gunicorn settings for InstaClaw
+Picked up automatically by `gunicorn app:app`; command-line flags still win
+"""
+
+import os
+import threading
+
+# The API is I/O-bound (one upstream LLM call per request), so gevent workers
+# multiplex many in-flight requests per process
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+
+if worker_class == 'gevent':
+    # Patch before the app imports anything that opens sockets or creates locks
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+# A small fixed default: os.cpu_count() sees the host's CPUs, not the
+# container's quota, and each worker holds its own SQLite cache and mmap
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 500))
+timeout = 120
+
+# Import the app once in the master and fork workers from it, so imports,
+# init_db() and the module-level tables are shared copy-on-write
+preload_app = True
+
+
+def when_ready(server):
+    """Wait for timers the app started at import (flask-limiter's in-memory
+    expiry timer) to finish in the master, so no pending greenlet is copied
+    into a worker"""
+    for thread in threading.enumerate():
+        if isinstance(thread, threading.Timer):
+            thread.join()
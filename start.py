@@ -19,10 +19,6 @@ def main():
     """Main startup function with error handling"""
     print("🦞 InstaClaw Starting Up...")
     
-    # Set signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
     # Get deployment configuration
     port = int(os.getenv('PORT', 5000))
     host = os.getenv('HOST', '0.0.0.0')
@@ -49,14 +45,21 @@ def main():
     
     try:
         print(f"🚀 Starting Flask server on {host}:{port}")
+        # Gunicorn replaces this process, so Railway's SIGTERM reaches it directly
         if environment == "production":
             # Use Gunicorn for production
-            import subprocess
             cmd = f"gunicorn app:app --bind {host}:{port} --workers 2 --timeout 120"
-            subprocess.run(cmd.split())
-        else:
-            # Use Flask dev server
+            os.execvp("gunicorn", cmd.split())
+        elif debug:
+            # Flask dev server, for the reloader and interactive debugger
+            signal.signal(signal.SIGINT, signal_handler)
+            signal.signal(signal.SIGTERM, signal_handler)
             app.run(host=host, port=port, debug=debug, threaded=True)
+        else:
+            # Gunicorn with threaded workers locally too; the worker class goes
+            # through the environment so gunicorn.conf.py skips gevent patching
+            cmd = f"gunicorn app:app --bind {host}:{port} --workers 2 --threads 8 --keep-alive 5 --preload"
+            os.execvpe("gunicorn", cmd.split(), {**os.environ, 'GUNICORN_WORKER_CLASS': 'gthread'})
             
     except Exception as e:
         print(f"❌ Failed to start server: {e}")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+BatchScheduler Tests
+Runs in-process against fake provider clients; no server or API keys needed
+"""
+
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import app
+
+class FakeCompletions:
+    """chat.completions stand-in that answers with too few choices, or never"""
+
+    def __init__(self, delay=0.0, choices=()):
+        self.delay = delay
+        self.choices = list(choices)
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(choices=self.choices,
+                               usage=SimpleNamespace(prompt_tokens=1, completion_tokens=0))
+
+def with_fake_openai(completions, test):
+    """Run test() with the given fake OpenAI client. A model's queue keeps the
+    client it was first called with, so each test uses a model of its own"""
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    get_client = app.get_openai_client
+    app.get_openai_client = lambda: client
+    try:
+        return test()
+    finally:
+        app.get_openai_client = get_client
+
+def test_short_response_resolves_every_caller():
+    """Callers left without a completion fail instead of waiting forever"""
+    print("🔍 Testing a provider response with too few completions...")
+
+    async def run():
+        scheduler = app.BatchScheduler()
+        async def dispatch(prompt, n):
+            return []
+        key = ('openai', 'gpt-3.5-turbo', app.LLM_MAX_TOKENS)
+        return await asyncio.wait_for(asyncio.gather(
+            *(scheduler.submit(key, 'same prompt', dispatch) for _ in range(3)),
+            return_exceptions=True), 1)
+
+    results = asyncio.run(run())
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
+    print("✅ Every caller resolved")
+
+def test_short_response_falls_back_to_mock():
+    """Coalesced callers of a client returning no choices all get the mock"""
+    print("🔍 Testing fallback for a client returning no choices...")
+
+    def run():
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            return list(executor.map(lambda _: app.call_openai_api('hi', 'gpt-3.5-turbo'), range(3)))
+
+    results = with_fake_openai(FakeCompletions(delay=0.05), run)
+    assert len(results) == 3
+    assert all(result['response'].startswith('[MOCK]') for result in results)
+    print("✅ All callers fell back to the mock")
+
+def test_unresponsive_provider_times_out():
+    """run_async gives up after LLM_CALL_TIMEOUT and the call falls back"""
+    print("🔍 Testing timeout on a provider that never answers...")
+
+    call_timeout = app.LLM_CALL_TIMEOUT
+    app.LLM_CALL_TIMEOUT = 0.2
+    try:
+        t0 = time.monotonic()
+        result = with_fake_openai(FakeCompletions(delay=10), lambda: app.call_openai_api('hi', 'gpt-4'))
+        elapsed = time.monotonic() - t0
+    finally:
+        app.LLM_CALL_TIMEOUT = call_timeout
+    assert result['response'].startswith('[MOCK]')
+    assert elapsed < 2, f"call took {elapsed:.2f}s"
+    print("✅ Call timed out and fell back to the mock")
+
+def test_unknown_models_are_not_queued():
+    """Made-up model names go straight to dispatch and leave no queue behind"""
+    print("🔍 Testing that unknown models are not coalesced...")
+
+    async def run():
+        scheduler = app.BatchScheduler()
+        async def dispatch(prompt, n):
+            return [prompt] * n
+        results = await asyncio.gather(
+            *(scheduler.submit(('openai', f'made-up-{i}', app.LLM_MAX_TOKENS), 'hi', dispatch)
+              for i in range(50)))
+        return scheduler, results
+
+    scheduler, results = asyncio.run(run())
+    assert results == ['hi'] * 50
+    assert not scheduler._queues
+    assert not scheduler._tasks
+    print("✅ No queues or consumer tasks for unknown models")
+
+def run_all_tests():
+    """Run all tests"""
+    print("🚀 Starting BatchScheduler Tests\n")
+
+    try:
+        test_short_response_resolves_every_caller()
+        test_short_response_falls_back_to_mock()
+        test_unresponsive_provider_times_out()
+        test_unknown_models_are_not_queued()
+
+        print("\n🎉 All tests passed! Provider calls always resolve.")
+
+    except Exception as e:
+        print(f"\n❌ Test failed: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_all_tests()
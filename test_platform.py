@@ -8,14 +8,19 @@ import requests
 import json
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = "http://localhost:5000"
 API_KEY = "demo_fe01ce2a7fbac8fa"
 
+# One keep-alive session for every test instead of a new connection per request
+SESSION = requests.Session()
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def test_health_check():
     """Test basic health endpoint"""
     print("🔍 Testing health check...")
-    response = requests.get(f"{BASE_URL}/health")
+    response = SESSION.get(f"{BASE_URL}/health")
     assert response.status_code == 200
     data = response.json()
     assert data["status"] == "healthy"
@@ -38,7 +43,7 @@ def test_unified_api():
         "Content-Type": "application/json"
     }
     
-    response = requests.post(f"{BASE_URL}/api/openclaw", json=payload, headers=headers)
+    response = SESSION.post(f"{BASE_URL}/api/openclaw", json=payload, headers=headers)
     assert response.status_code == 200
     
     data = response.json()
@@ -67,11 +72,13 @@ def test_page_accessibility():
         "/auth/register"
     ]
     
-    for page in pages:
-        response = requests.get(f"{BASE_URL}{page}")
-        # Most pages should either return 200 (login/register) or 302 (redirect to login)
-        assert response.status_code in [200, 302], f"Page {page} returned {response.status_code}"
-        print(f"✅ Page {page} accessible")
+    # The pages are independent, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = executor.map(lambda page: SESSION.get(f"{BASE_URL}{page}"), pages)
+        for page, response in zip(pages, responses):
+            # Most pages should either return 200 (login/register) or 302 (redirect to login)
+            assert response.status_code in [200, 302], f"Page {page} returned {response.status_code}"
+            print(f"✅ Page {page} accessible")
 
 def test_api_key_validation():
     """Test API key validation"""
@@ -85,11 +92,11 @@ def test_api_key_validation():
     
     payload = {"tools": [{"tool": "web_search", "query": "test"}]}
     
-    response = requests.post(f"{BASE_URL}/api/openclaw", json=payload, headers=headers)
+    response = SESSION.post(f"{BASE_URL}/api/openclaw", json=payload, headers=headers)
     assert response.status_code == 401
     
     # Test with missing API key
-    response = requests.post(f"{BASE_URL}/api/openclaw", json=payload)
+    response = SESSION.post(f"{BASE_URL}/api/openclaw", json=payload)
     assert response.status_code == 401
     
     print("✅ API key validation working")